@@ -1,23 +1,55 @@
 # ============================================================
 #  JxFeedBot - Multi-Coin Telegram Price Poster (CoinGecko REST)
 #  Coins: BTC, ETH, BNB, SOL, XRP, XPR
-#  Render WebService keep-alive via Flask + robust TG logging
+#  Render WebService keep-alive via http.server + robust TG logging
 # ============================================================
 
-import os, time, signal, sys, requests, threading, random
+import os, time, signal, socket, sys, requests, threading, orjson
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # ---------- keep-alive server for Render ----------
-from flask import Flask, jsonify
-app = Flask(__name__)
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-@app.get("/")
-def home():
-    return "JxFeedBot running ✅"
+_HOME = "JxFeedBot running ✅".encode()
+
+class KeepAlive(BaseHTTPRequestHandler):
+    def route(self):
+        # -> (status, body bytes, content type); handlers below are looked
+        # up at request time, so they can live further down the module.
+        # Match the path only; pingers often append cache-busting queries.
+        path = urlsplit(self.path).path
+        if path == "/":
+            return 200, _HOME, "text/plain; charset=utf-8"
+        if path == "/prices":
+            return 200, orjson.dumps(_cache["prices"]), "application/json"
+        if path == "/post-now":
+            status, body = post_now()
+            return status, orjson.dumps(body), "application/json"
+        return 404, b"Not Found", "text/plain; charset=utf-8"
+
+    def reply(self, head_only: bool):
+        status, body, ctype = self.route()
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(head_only=False)
+
+    def do_HEAD(self):
+        self.reply(head_only=True)
 
 def keep_alive():
     port = int(os.getenv("PORT", "10000"))
-    app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False)
+    ThreadingHTTPServer(("0.0.0.0", port), KeepAlive).serve_forever()
 
 # Start the web server in a background thread
 threading.Thread(target=keep_alive, daemon=True).start()
@@ -49,6 +81,7 @@ POLL_SECONDS   = int(env("POLL_SECONDS", "120"))   # slower default to avoid 429
 PRICE_DECIMALS = int(env("PRICE_DECIMALS", "2"))
 MIN_ABS_MOVE   = float(env("MIN_ABS_MOVE", "0"))
 LOG_ERRORS     = env("LOG_ERRORS", "true").lower() == "true"
+STATE_FILE     = env("STATE_FILE", "/tmp/jxfeed_state.json")  # last posted prices
 
 # Debug: show what env keys we actually see
 seen_keys = [k for k in os.environ.keys() if k.startswith("CHAT_") or "TELEGRAM" in k]
@@ -65,136 +98,302 @@ CG_IDS = {
     "XPR": "proton",
 }
 CG_URL = "https://api.coingecko.com/api/v3/simple/price"
-CG_TIMEOUT = 15
+# (connect, read) timeouts for every outbound call so one stuck peer can't
+# hold a worker (or the poll loop) for long; the socket default is a
+# backstop for anything that opens a socket without its own timeout
+HTTP_TIMEOUT = (3, 10)
+socket.setdefaulttimeout(20)
 http = requests.Session()
 http.headers.update({"User-Agent": "JxFeedBot/1.0"})
+# Skip requests' per-call proxy-env / .netrc lookups; we talk directly to
+# two fixed HTTPS hosts and never use either
+http.trust_env = False
+# Keep-alive pool sized for the parallel Telegram posts; urllib3 retries
+# 429/5xx with exponential backoff and honours Retry-After. With
+# raise_on_status=False the last response is returned, so callers still
+# see a requests.HTTPError from raise_for_status(). read=False: a timeout
+# after the request was sent is never replayed, since Telegram may have
+# already accepted the sendMessage. A 5xx from a gateway in front of
+# Telegram is still retried for POST, so a duplicate post remains
+# possible in that case.
+retry = Retry(
+    total=4,
+    read=False,
+    status_forcelist=[429, 500, 502, 503, 504],
+    backoff_factor=1.0,
+    respect_retry_after_header=True,
+    allowed_methods=["GET", "POST"],
+    raise_on_status=False,
+)
+http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                   pool_block=False, max_retries=retry))
 
-def cg_params():
-    # Build each time in case you later toggle coins via env
-    return {"ids": ",".join(CG_IDS.values()), "vs_currencies": "usd"}
+# CG_IDS is fixed at startup, so encode the query string once
+CG_PARAMS = {"ids": ",".join(CG_IDS.values()), "vs_currencies": "usd"}
+CG_FULL_URL = f"{CG_URL}?{urlencode(CG_PARAMS)}"
+_CG_ITEMS = tuple(CG_IDS.items())
+_EMPTY = {}  # shared stand-in for coins missing from the response; never mutated
 
 # ------------------- State -------------------
 last_price = {s: None for s in CHANNELS}
+# last posted price scaled to PRICE_DECIMALS, compared as ints
+last_tick = {s: None for s in CHANNELS}
 _stop = False
+_state_lock = threading.Lock()
+
+# One worker per channel so a slow chat never stalls the others
+executor = ThreadPoolExecutor(max_workers=len(CHANNELS))
 
 # ------------------- Helpers -------------------
-def fmt_usd(v: float) -> str:
-    return f"$ {v:,.{PRICE_DECIMALS}f}"
+_SCALE = 10 ** PRICE_DECIMALS
+_FMT = f"$ {{:,.{PRICE_DECIMALS}f}}".format
+
+# Price and posting helpers bind module constants/state as default args so
+# lookups are locals, not globals. At one poll per POLL_SECONDS the saving
+# is negligible; it only pays off for a high-frequency (WebSocket) feed,
+# which chunk0-15 declined. Constraint: because last_price/last_tick (and
+# http, CHANNELS) are bound this way, they must only ever be mutated in
+# place, never reassigned.
+def fmt_usd(v: float, _fmt=_FMT) -> str:
+    return _fmt(v)
 
-def should_post(sym: str, new_price: float) -> bool:
-    prev = last_price.get(sym)
+def to_tick(v: float, _scale=_SCALE) -> int:
+    # price rounded to PRICE_DECIMALS as an int (prices are positive)
+    return int(v * _scale + 0.5)
+
+def load_state():
+    # Restore last posted prices so a restart doesn't re-post unchanged ones
+    try:
+        with open(STATE_FILE, "rb") as f:
+            saved = orjson.loads(f.read())
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Ignoring unreadable state file {STATE_FILE}: {e}")
+        return
+    if not isinstance(saved, dict):
+        print(f"[WARN] Ignoring state file {STATE_FILE}: expected an object, got {type(saved).__name__}")
+        return
+    for sym, price in saved.items():
+        if sym not in last_price or price is None:
+            continue
+        try:
+            last_price[sym] = float(price)
+        except (TypeError, ValueError) as e:
+            print(f"[WARN] Ignoring saved price for {sym} in {STATE_FILE}: {e}")
+            continue
+        last_tick[sym] = to_tick(last_price[sym])
+    print(f"[INIT] Restored last prices from {STATE_FILE}: {saved}")
+
+def save_state():
+    # Write-then-rename so a crash mid-write never leaves a torn file
+    tmp = STATE_FILE + ".tmp"
+    try:
+        with _state_lock:
+            with open(tmp, "wb") as f:
+                f.write(orjson.dumps(last_price))
+            os.replace(tmp, STATE_FILE)
+    except OSError as e:
+        print(f"[WARN] Could not save state to {STATE_FILE}: {e}")
+
+def should_post(sym: str, new_price: float, _last=last_price, _ticks=last_tick,
+                _mov=MIN_ABS_MOVE, _tick=to_tick) -> bool:
+    prev = _last.get(sym)
     if prev is None:
         return True
-    if round(new_price, PRICE_DECIMALS) != round(prev, PRICE_DECIMALS):
-        if MIN_ABS_MOVE > 0 and abs(new_price - prev) < MIN_ABS_MOVE:
-            return False
-        return True
-    return False
+    if _ticks.get(sym) == _tick(new_price):
+        return False
+    if _mov > 0 and abs(new_price - prev) < _mov:
+        return False
+    return True
+
+# Built once; the session already sends Connection: keep-alive
+_HDR = {"Content-Type": "application/json"}
 
-def tg_post(chat_id: str, text: str) -> requests.Response:
-    payload = {"chat_id": chat_id, "text": text, "disable_web_page_preview": True}
-    r = http.post(TG_SEND_URL, json=payload, timeout=12)
+def tg_post(chat_id: str, text: str, _http=http, _url=TG_SEND_URL, _hdr=_HDR,
+            _timeout=HTTP_TIMEOUT) -> requests.Response:
+    # orjson emits bytes, so the body goes out without a str -> bytes pass
+    body = orjson.dumps({"chat_id": chat_id, "text": text, "disable_web_page_preview": True})
+    r = _http.post(_url, data=body, headers=_hdr, timeout=_timeout)
     if r.status_code != 200:
         # Print exact error body so we know 403 vs 400 etc.
         print(f"[TG ERROR] status={r.status_code} chat={chat_id} body={r.text}")
     r.raise_for_status()
     return r
 
-def post_price(sym: str, price: float):
-    chat = CHANNELS[sym]
+def post_chat(chat: str, items: list, _last=last_price, _ticks=last_tick) -> bool:
+    # One sendMessage per chat; several symbols sharing a chat are
+    # combined into a multi-line body, a lone symbol keeps the plain price.
+    # Returns whether the post went through.
+    if len(items) == 1:
+        text = fmt_usd(items[0][1])
+    else:
+        text = "\n".join(f"{sym}: {fmt_usd(price)}" for sym, price in items)
+    syms = ",".join(sym for sym, _ in items)
     try:
-        tg_post(chat, fmt_usd(price))
-        last_price[sym] = price
-        print(f"[OK] {sym} → {chat}: {fmt_usd(price)}")
+        tg_post(chat, text)
+        for sym, price in items:
+            _last[sym] = price
+            _ticks[sym] = to_tick(price)
+        print(f"[OK] {syms} → {chat}: {text}")
+        save_state()
+        return True
     except Exception as e:
         if LOG_ERRORS:
-            print(f"[ERROR] Telegram post failed for {sym} → {chat}: {e}")
+            print(f"[ERROR] Telegram post failed for {syms} → {chat}: {e}")
+        return False
+
+def post_prices(to_send, _channels=CHANNELS) -> list:
+    # Group (sym, price) pairs by destination chat, then fan the batches
+    # out over the shared executor and wait for all. Returns the
+    # (sym, price) pairs that were actually posted.
+    by_chat = defaultdict(list)
+    for sym, price in to_send:
+        by_chat[_channels[sym]].append((sym, price))
+    batches = list(by_chat.items())
+    results = executor.map(lambda item: post_chat(*item), batches)
+    return [sp for (_, items), ok in zip(batches, results) if ok for sp in items]
+
+def ping_live(sym: str, chat: str):
+    # Fallback for symbols with no price yet: still show the bot is live
+    try:
+        tg_post(chat, f"🟢 JxFeedBot live for {sym}")
+        print(f"[LIVE] Pinged {sym} → {chat}")
+    except Exception as e:
+        if LOG_ERRORS:
+            print(f"[ERROR] Live ping failed for {sym} → {chat}: {e}")
 
 def fetch_prices() -> dict:
-    r = http.get(CG_URL, params=cg_params(), timeout=CG_TIMEOUT)
+    r = http.get(CG_FULL_URL, timeout=HTTP_TIMEOUT)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     out = {}
-    for sym, cg_id in CG_IDS.items():
-        usd = data.get(cg_id, {}).get("usd")
+    for sym, cg_id in _CG_ITEMS:
+        usd = (data.get(cg_id) or _EMPTY).get("usd")
         if usd is not None:
             out[sym] = float(usd)
     return out
 
+# Shared snapshot so every reader within one poll window reuses a single
+# upstream call; the lock keeps concurrent readers from double-fetching.
+# loop() is the producer: its first pass reuses the startup snapshot, later
+# cycles refresh (force=True) so a slow or retried fetch can't make the
+# next cycle reuse the previous snapshot.
+# fetch_prices() runs under the lock and can sit in urllib3 Retry sleeps
+# for minutes, so non-forced readers (/post-now) wait at most CACHE_WAIT
+# and then fall back to the last snapshot.
+_cache = {"t": 0.0, "prices": {}}
+_cache_lock = threading.Lock()
+CACHE_TTL = max(POLL_SECONDS - 1, 0)
+CACHE_WAIT = 5
+
+def get_prices(force: bool = False) -> dict:
+    if not _cache_lock.acquire(timeout=-1 if force else CACHE_WAIT):
+        if _cache["t"]:
+            return _cache["prices"]
+        raise RuntimeError("price fetch in progress and no snapshot yet")
+    try:
+        if not force and _cache["t"] and time.monotonic() - _cache["t"] < CACHE_TTL:
+            return _cache["prices"]
+        p = fetch_prices()
+        _cache.update(t=time.monotonic(), prices=p)
+        return p
+    finally:
+        _cache_lock.release()
+
 # ---- Startup: fetch once and post actual prices (not just a ping)
 def startup_post_prices():
     try:
-        prices = fetch_prices()
+        prices = get_prices()
+        to_send, pings = [], []
         for sym, chat in CHANNELS.items():
             if not chat:
                 continue
             p = prices.get(sym)
-            if p is not None:
-                print(f"[INIT] Startup post for {sym} at {fmt_usd(p)}")
-                post_price(sym, p)
+            if p is None:
+                pings.append(executor.submit(ping_live, sym, chat))
+            elif should_post(sym, p):
+                to_send.append((sym, p))
             else:
-                # Fallback: still show "live" if price missing
-                tg_post(chat, f"🟢 JxFeedBot live for {sym}")
-                print(f"[LIVE] Pinged {sym} → {chat}")
+                print(f"[INIT] {sym} unchanged since last run at {fmt_usd(p)}")
+        # pings handle their own errors, so the price posts always go out
+        for sym, p in post_prices(to_send):
+            print(f"[INIT] Startup post for {sym} at {fmt_usd(p)}")
+        for f in pings:
+            f.result()
     except Exception as e:
         print(f"[LIVE ERROR] startup price fetch failed: {e}")
 
-# ---- Force a manual post (for testing)
-@app.get("/post-now")
+# ---- Force a manual post (for testing), served at /post-now
 def post_now():
     try:
-        prices = fetch_prices()
-        for sym, price in prices.items():
-            if sym in CHANNELS and CHANNELS[sym]:
-                post_price(sym, price)
-        return jsonify({"ok": True})
+        prices = get_prices()
+        post_prices([(sym, price) for sym, price in prices.items()
+                     if sym in CHANNELS and CHANNELS[sym]])
+        return 200, {"ok": True}
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+        return 500, {"ok": False, "error": str(e)}
 
 def loop():
-    backoff = POLL_SECONDS
     print(f"✅ JxFeedBot running (every {POLL_SECONDS}s)…")
+    # Fixed-rate schedule: sleep until the next deadline rather than a
+    # full POLL_SECONDS, so fetch/post time doesn't accumulate as drift
+    next_t = time.monotonic()
+    first = True
     while not _stop:
         try:
-            prices = fetch_prices()
-            for sym, price in prices.items():
-                chat = CHANNELS.get(sym)
-                if not chat:
-                    continue
-                # First time we see a price for this sym, we post it
-                if last_price[sym] is None:
-                    print(f"[INIT] First post for {sym} at {fmt_usd(price)}")
-                    post_price(sym, price)
-                    continue
-                if should_post(sym, price):
-                    post_price(sym, price)
-
-            # normal cadence
-            time.sleep(POLL_SECONDS)
-            backoff = POLL_SECONDS
+            # first pass shares the startup fetch; afterwards always refresh
+            prices = get_prices(force=not first)
+            first = False
+            new_ticks = {sym: to_tick(price) for sym, price in prices.items()}
+            # Fast path: every fetched price rounds to what we last posted
+            if not new_ticks.items() <= last_tick.items():
+                to_send = []
+                for sym, price in prices.items():
+                    if not CHANNELS.get(sym):
+                        continue
+                    # First time we see a price for this sym, we post it
+                    if last_price[sym] is None:
+                        print(f"[INIT] First post for {sym} at {fmt_usd(price)}")
+                        to_send.append((sym, price))
+                    elif should_post(sym, price):
+                        to_send.append((sym, price))
+
+                # post all changed symbols in parallel, one request per chat
+                post_prices(to_send)
+
+            # normal cadence; after an overlong cycle (e.g. Retry-After
+            # waits) skip the missed slots instead of replaying them back
+            # to back, staying on the original phase
+            next_t += POLL_SECONDS
+            now = time.monotonic()
+            if next_t < now:
+                next_t += ((now - next_t) // POLL_SECONDS + 1) * POLL_SECONDS
+            time.sleep(next_t - now)
 
         except requests.HTTPError as e:
+            # 429/5xx were already retried with backoff by the adapter,
+            # other statuses fail straight away; either way skip this cycle
             status = getattr(e.response, "status_code", None)
-            if status in (429, 500, 502, 503, 504):
-                # backoff with jitter to avoid CG buckets
-                base = max(backoff * 1.5, 60)
-                jitter = random.randint(0, 45)
-                backoff = int(min(base + jitter, 300))
-                print(f"[WARN] CoinGecko HTTP {status}. Backing off {backoff}s…")
-                time.sleep(backoff)
+            if status in retry.status_forcelist:
+                print(f"[WARN] CoinGecko HTTP {status} after retries: {e}")
             else:
-                print("[HTTP ERROR]", e)
-                time.sleep(backoff)
+                print(f"[WARN] CoinGecko HTTP {status}: {e}")
+            next_t = time.monotonic() + POLL_SECONDS
+            time.sleep(POLL_SECONDS)
 
         except Exception as e:
             print("[ERROR]", e)
-            # small randomized sleep to avoid hot loops
-            time.sleep(min(backoff, 120))
+            # capped sleep to avoid hot loops
+            backoff = min(POLL_SECONDS, 120)
+            next_t = time.monotonic() + backoff
+            time.sleep(backoff)
 
 def shutdown(*_):
     global _stop
     _stop = True
     try:
+        executor.shutdown(wait=False)
         http.close()
     finally:
         print("Shutting down cleanly…")
@@ -210,6 +409,9 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, shutdown)
     signal.signal(signal.SIGTERM, shutdown)
 
+    # Pick up where the previous run left off
+    load_state()
+
     # Post prices immediately on boot
     startup_post_prices()
 